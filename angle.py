@@ -15,6 +15,7 @@ import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.data import DataLoader
 from boltons.iterutils import chunked_iter
 from datasets import Dataset
 from transformers import (
@@ -22,7 +23,8 @@ from transformers import (
     PreTrainedModel, Trainer, TrainingArguments
 )
 from transformers.tokenization_utils_base import PreTrainedTokenizerBase
-from transformers.utils import PaddingStrategy
+from transformers.trainer_utils import seed_worker
+from transformers.utils import PaddingStrategy, is_torch_bf16_gpu_available, is_torch_tf32_available
 from peft import (
     get_peft_model, LoraConfig, TaskType, PeftModel,
     prepare_model_for_kbit_training,
@@ -199,57 +201,66 @@ class AngleDataTokenizer:
         to_fix_ids = prompt_ids[bad_index:]
         return token_ids[:len(token_ids) - len(to_fix_ids)] + to_fix_ids
 
+    def fix_prompt_ending(self, tok: Dict):
+        prompt_ids = self.prompt_template_tok['input_ids']
+        if tok['input_ids'][-1] == prompt_ids[-1]:
+            return
+        print('bad data:', f"token ids: {tok['input_ids']}, prompt token ids: {prompt_ids}")
+        tok['input_ids'] = self.fix_bad_data(tok['input_ids'], prompt_ids)
+        try:
+            assert len(tok['input_ids']) == len(tok['attention_mask'])
+            assert tok['input_ids'][-1] == prompt_ids[-1]
+            print('fixed it ;)')
+            print('new data:', f"token ids: {tok['input_ids']}, prompt token ids: {prompt_ids}")
+        except AssertionError:
+            print('failed to fix it :()')
+
     def __call__(self, data: Dict) -> Dict:
-        extra_length = 0
-        extra_placeholder = {}
-        for key, val in data.items():
-            if key in ['text1', 'text2', 'label']:
-                continue
-            extra_placeholder[key] = val
-            extra_length += len(self.tokenizer(val, add_special_tokens=False)['input_ids'])
-        if self.prompt_template_tok is not None:
-            tok1 = self.tokenizer(data['text1'],
-                                  max_length=self.max_length - len(self.prompt_template_tok['input_ids']) - extra_length,
-                                  truncation=True,
-                                  add_special_tokens=False)
-            data['text1'] = self.tokenizer.decode(tok1['input_ids'])
-            data['text1'] = self.prompt_template.format(text=data['text1'], **extra_placeholder)
-            tok2 = self.tokenizer(data['text2'],
-                                  max_length=self.max_length - len(self.prompt_template_tok['input_ids']) - extra_length,
-                                  truncation=True,
-                                  add_special_tokens=False)
-            data['text2'] = self.tokenizer.decode(tok2['input_ids'])
-            data['text2'] = self.prompt_template.format(text=data['text2'], **extra_placeholder)
-
-        tok1 = self.tokenizer(data['text1'], max_length=self.max_length, truncation=True)
-        tok2 = self.tokenizer(data['text2'], max_length=self.max_length, truncation=True)
-        if self.prompt_template_tok is not None:
-            if tok1['input_ids'][-1] != self.prompt_template_tok['input_ids'][-1]:
-                print('bad data:', f"token ids: {tok1['input_ids']}, prompt token ids: {self.prompt_template_tok['input_ids']}")
-                tok1['input_ids'] = self.fix_bad_data(tok1['input_ids'], self.prompt_template_tok['input_ids'])
-                try:
-                    assert len(tok1['input_ids']) == len(tok1['attention_mask'])
-                    assert tok1['input_ids'][-1] == self.prompt_template_tok['input_ids'][-1]
-                    print('fixed it ;)')
-                    print('new data:', f"token ids: {tok1['input_ids']}, prompt token ids: {self.prompt_template_tok['input_ids']}")
-                except AssertionError:
-                    print('failed to fix it :()')
-            if tok2['input_ids'][-1] != self.prompt_template_tok['input_ids'][-1]:
-                print('bad data:', f"token ids: {tok2['input_ids']}, prompt token ids: {self.prompt_template_tok['input_ids']}")
-                tok2['input_ids'] = self.fix_bad_data(tok2['input_ids'], self.prompt_template_tok['input_ids'])
-                try:
-                    assert len(tok2['input_ids']) == len(tok2['attention_mask'])
-                    assert tok2['input_ids'][-1] == self.prompt_template_tok['input_ids'][-1]
-                    print('fixed it ;)')
-                    print('new data:', f"token ids: {tok2['input_ids']}, prompt token ids: {self.prompt_template_tok['input_ids']}")
-                except AssertionError:
-                    print('failed to fix it :()')
-        tok = {}
-        for key, val in tok1.items():
-            tok[key] = val + tok2[key]
-        tok['labels'] = [int(data['label'])]
-        tok['seperate_ids'] = [0] * len(tok1['input_ids']) + [1] * len(tok2['input_ids'])
-        return tok
+        if isinstance(data['text1'], (list, tuple)):
+            return self.tokenize(data)
+        # single example: tokenize it as a batch of one
+        tok = self.tokenize({key: [val] for key, val in data.items()})
+        return {key: val[0] for key, val in tok.items()}
+
+    def tokenize(self, batch: Dict[str, List]) -> Dict[str, List]:
+        """tokenize a batch (dict of lists) with one tokenizer call per text column
+        """
+        size = len(batch['text1'])
+        extra_keys = [key for key in batch if key not in ['text1', 'text2', 'label']]
+        extra_lengths = [0] * size
+        for key in extra_keys:
+            for i, ids in enumerate(self.tokenizer(batch[key], add_special_tokens=False)['input_ids']):
+                extra_lengths[i] += len(ids)
+
+        toks = []
+        for name in ['text1', 'text2']:
+            texts = batch[name]
+            if self.prompt_template_tok is not None:
+                prompt_length = len(self.prompt_template_tok['input_ids'])
+                text_ids = self.tokenizer(texts, add_special_tokens=False)['input_ids']
+                texts = self.tokenizer.batch_decode([
+                    ids[:max(self.max_length - prompt_length - extra_length, 0)]
+                    for ids, extra_length in zip(text_ids, extra_lengths)
+                ])
+                texts = [
+                    self.prompt_template.format(text=text, **{key: batch[key][i] for key in extra_keys})
+                    for i, text in enumerate(texts)
+                ]
+            tok = self.tokenizer(texts, max_length=self.max_length, truncation=True)
+            tok = [{key: val[i] for key, val in tok.items()} for i in range(size)]
+            if self.prompt_template_tok is not None:
+                for item in tok:
+                    self.fix_prompt_ending(item)
+            toks.append(tok)
+
+        outputs = defaultdict(list)
+        for tok1, tok2, label in zip(*toks, batch['label']):
+            for key, val in tok1.items():
+                outputs[key].append(val + tok2[key])
+            outputs['labels'].append([int(label)])
+            outputs['seperate_ids'].append([0] * len(tok1['input_ids']) + [1] * len(tok2['input_ids']))
+            outputs['input_ids_lengths'].append(len(tok1['input_ids']) + len(tok2['input_ids']))
+        return dict(outputs)
 
 
 @dataclass
@@ -257,6 +268,7 @@ class AngleDataCollator:
     tokenizer: PreTrainedTokenizerBase
     padding: Union[bool, str, PaddingStrategy] = 'longest'
     max_length: Optional[int] = None
+    pad_to_multiple_of: Optional[int] = None
     compute_similar_matrix: bool = True
     return_tensors: str = "pt"
 
@@ -311,12 +323,14 @@ class AngleDataCollator:
             {'input_ids': [feature['input_ids'] for feature in new_features]},
             padding=self.padding,
             max_length=self.max_length,
+            pad_to_multiple_of=self.pad_to_multiple_of,
             return_tensors=return_tensors,
         )
         features['attention_mask'] = self.tokenizer.pad(
             {'input_ids': [feature['attention_mask'] for feature in new_features]},
             padding=self.padding,
             max_length=self.max_length,
+            pad_to_multiple_of=self.pad_to_multiple_of,
             return_tensors=return_tensors,
         )['input_ids']
         if has_token_type_ids:
@@ -324,6 +338,7 @@ class AngleDataCollator:
                 {'input_ids': [feature['token_type_ids'] for feature in new_features]},
                 padding=self.padding,
                 max_length=self.max_length,
+                pad_to_multiple_of=self.pad_to_multiple_of,
                 return_tensors=return_tensors,
             )['input_ids']
         features['labels'] = torch.Tensor([feature['labels'] for feature in new_features])
@@ -338,9 +353,12 @@ class Pooler:
         self.pooling_strategy = pooling_strategy
         self.is_llama = is_llama
     
-    def __call__(self, inputs) -> Any:
+    def __call__(self, inputs, model: Optional[nn.Module] = None) -> Any:
+        # forward with the given model (e.g. the DDP-wrapped backbone) if any, configs are read from self.model
+        if model is None:
+            model = self.model
         if self.is_llama:
-            hidden_states = self.model(output_hidden_states=True, return_dict=True, **inputs).hidden_states[-1]
+            hidden_states = model(output_hidden_states=True, return_dict=True, **inputs).hidden_states[-1]
             batch_size = hidden_states.shape[0]
             if self.model.config.pad_token_id is None and batch_size != 1:
                 raise ValueError("Cannot handle batch sizes > 1 if no padding token is defined.")
@@ -356,7 +374,7 @@ class Pooler:
 
             outputs = hidden_states[torch.arange(batch_size, device=hidden_states.device), sequence_lengths]
         else:
-            outputs = self.model(**inputs).last_hidden_state
+            outputs = model(**inputs).last_hidden_state
             if self.pooling_strategy == 'cls':
                 outputs = outputs[:, 0]
             elif self.pooling_strategy == 'cls_avg':
@@ -376,17 +394,58 @@ class AngleTrainer(Trainer):
     def __init__(self,
                  pooler: Pooler,
                  loss_kwargs: Optional[Dict] = None,
+                 dataloader_persistent_workers: bool = False,
+                 dataloader_prefetch_factor: Optional[int] = None,
                  **kwargs):
         super().__init__(**kwargs)
         self.pooler = pooler
+        self.dataloader_persistent_workers = dataloader_persistent_workers
+        self.dataloader_prefetch_factor = dataloader_prefetch_factor
         if loss_kwargs is None:
             loss_kwargs = {}
         self.loss_fct = AngleLoss(**loss_kwargs)
 
+    def get_train_dataloader(self) -> DataLoader:
+        """same as Trainer.get_train_dataloader, but without accelerate's device placement,
+        batches stay pinned on the host and are copied in `_prepare_input`
+        """
+        if self.train_dataset is None:
+            raise ValueError("Trainer: training requires a train_dataset.")
+
+        train_dataset = self.train_dataset
+        data_collator = self.data_collator
+        if isinstance(train_dataset, Dataset):
+            train_dataset = self._remove_unused_columns(train_dataset, description="training")
+        else:
+            data_collator = self._get_collator_with_removed_columns(data_collator, description="training")
+
+        dataloader_params = {
+            "batch_size": self._train_batch_size,
+            "collate_fn": data_collator,
+            "num_workers": self.args.dataloader_num_workers,
+            "pin_memory": self.args.dataloader_pin_memory,
+        }
+        if self.args.dataloader_num_workers > 0:
+            # keep workers alive across epochs instead of re-forking them every epoch
+            dataloader_params["persistent_workers"] = self.dataloader_persistent_workers
+            dataloader_params["prefetch_factor"] = self.dataloader_prefetch_factor
+        if not isinstance(train_dataset, torch.utils.data.IterableDataset):
+            dataloader_params["sampler"] = self._get_train_sampler()
+            dataloader_params["drop_last"] = self.args.dataloader_drop_last
+            dataloader_params["worker_init_fn"] = seed_worker
+
+        return self.accelerator.prepare(DataLoader(train_dataset, **dataloader_params), device_placement=[False])
+
+    def _prepare_input(self, data: Union[torch.Tensor, Any]) -> Union[torch.Tensor, Any]:
+        # pinned batches can be copied to the device asynchronously
+        if isinstance(data, torch.Tensor) and data.is_pinned():
+            return data.to(self.args.device, non_blocking=True)
+        return super()._prepare_input(data)
+
     def compute_loss(self, model, inputs, return_outputs=False):
         labels = inputs.pop("labels")
         similar_matrix = inputs.pop("similar_matrix", None)
-        outputs = self.pooler(inputs)
+        outputs = self.pooler(inputs, model=model)
         loss = self.loss_fct(labels, outputs, similar_matrix=similar_matrix)
         return (loss, outputs) if return_outputs else loss
 
@@ -403,6 +462,7 @@ class AnglE:
                  apply_lora: bool = False,
                  train_mode: bool = True,
                  load_kbit: Optional[int] = None,
+                 torch_dtype: Optional[torch.dtype] = None,
                  **kwargs: Any):
         super().__init__()
         self.max_length = max_length
@@ -424,7 +484,7 @@ class AnglE:
             if lora_config_kwargs is not None:
                 lora_config.update(lora_config_kwargs)
 
-        self.tokenizer = AutoTokenizer.from_pretrained(model_name_or_path)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name_or_path, use_fast=True)
         model_kwargs = model_kwargs if model_kwargs is not None else {}
         if self.is_llama:
             assert apply_lora, 'llama only support lora finetuning'
@@ -459,11 +519,11 @@ class AnglE:
                         load_in_4bit=True,
                         llm_int8_threshold=6.0,
                         llm_int8_has_fp16_weight=False,
-                        bnb_4bit_compute_dtype=torch.float32,
+                        bnb_4bit_compute_dtype=torch_dtype or torch.float32,
                         bnb_4bit_use_double_quant=True,
                         bnb_4bit_quant_type='nf4',
                     ),
-                    torch_dtype=torch.float32,
+                    torch_dtype=torch_dtype or torch.float32,
                     device_map=device_map,
                 )
                 if train_mode:
@@ -473,7 +533,7 @@ class AnglE:
                     print(f'lora target modules={target_modules}')
                     peft_config = LoraConfig(**lora_config)
                     model = get_peft_model(model, peft_config)
-                    model = AnglE.kbit_post_handle(model)
+                    model = AnglE.kbit_post_handle(model, dtype=torch_dtype or torch.float32)
                     model.print_trainable_parameters()
                 self.backbone = model
             else:
@@ -481,13 +541,17 @@ class AnglE:
                     model = AutoModelForCausalLM.from_pretrained(
                         model_name_or_path,
                         load_in_8bit=load_kbit == 8 ,
-                        torch_dtype=torch.float16 if load_kbit == 16 else torch.float32,
+                        torch_dtype=torch_dtype or (torch.float16 if load_kbit == 16 else torch.float32),
                         device_map=device_map,
                     )
                     if load_kbit == 8:
                         model = prepare_model_for_int8_training(model)
                     peft_config = LoraConfig(**lora_config)
                     model = get_peft_model(model, peft_config)
+                    # the base weights may be 16-bit, keep float32 master weights for the trainable adapters
+                    for param in model.parameters():
+                        if param.requires_grad:
+                            param.data = param.data.float()
                     model.print_trainable_parameters()
                 else:
                      print('>>>>> default load')
@@ -521,7 +585,9 @@ class AnglE:
         return self
 
     @staticmethod
-    def kbit_post_handle(model: nn.Module) -> nn.Module:
+    def kbit_post_handle(model: nn.Module, dtype: torch.dtype = torch.float32) -> nn.Module:
+        # lora adapters keep float32 master weights and norms stay in float32 for stability,
+        # only lm_head / embed_tokens follow `dtype`
         for name, module in model.named_modules():
             if isinstance(module, LoraLayer):
                 module = module.to(torch.float32)
@@ -529,7 +595,7 @@ class AnglE:
                 module = module.to(torch.float32)
             if 'lm_head' in name or 'embed_tokens' in name:
                 if hasattr(module, 'weight'):
-                    module = module.to(torch.float32)
+                    module = module.to(dtype)
         return model
 
     @staticmethod
@@ -596,6 +662,13 @@ class AnglE:
             save_total_limit: int = 10,
             gradient_accumulation_steps: int = 1,
             fp16: Optional[bool] = None,
+            bf16: bool = False,
+            dataloader_num_workers: int = 0,
+            pin_memory: bool = True,
+            persistent_workers: bool = True,
+            prefetch_factor: Optional[int] = None,
+            group_by_length: bool = False,
+            torch_compile: bool = False,
             argument_kwargs: Optional[Dict] = None,
             trainer_kwargs: Optional[Dict] = None,
             loss_kwargs: Optional[Dict] = None,):
@@ -607,7 +680,15 @@ class AnglE:
 
         if self.gpu_count > 1:
             gradient_accumulation_steps = gradient_accumulation_steps // self.gpu_count
-        if fp16 is None and self.is_llama:
+        # launched by torchrun
+        is_ddp = int(os.environ.get('LOCAL_RANK', -1)) >= 0
+        # same check as TrainingArguments, torch's is_bf16_supported() also accepts emulated bf16
+        if bf16 and not is_torch_bf16_gpu_available():
+            logger.warning('bf16 is not supported on this device, disable it')
+            bf16 = False
+        if bf16:
+            fp16 = False
+        elif fp16 is None and self.is_llama:
             fp16 = True
         else:
             fp16 = False
@@ -615,12 +696,27 @@ class AnglE:
             argument_kwargs = {}
         if trainer_kwargs is None:
             trainer_kwargs = {}
+        padding = 'longest'
+        # only llama (pad-aware last token) and cls pooling ignore extra padding,
+        # the other bert poolers (last / avg / max / cls_avg) would read pad positions.
+        pad_insensitive = self.is_llama or self.pooling_strategy == 'cls'
+        if torch_compile and torch.__version__ >= "2" and sys.platform != "win32":
+            # compile the forward only, so that the Trainer still wraps and saves the original backbone.
+            if group_by_length or not pad_insensitive:
+                # batch lengths vary, compile a single dynamic-shape graph without cuda graphs
+                self.backbone.forward = torch.compile(self.backbone.forward, mode='default', dynamic=True)
+            else:
+                # pad to max_length to keep input shapes static and capture a single cuda graph
+                self.backbone.forward = torch.compile(self.backbone.forward, mode='reduce-overhead', dynamic=False)
+                padding = 'max_length'
         trainer = AngleTrainer(
             pooler=self.pooler,
             model=self.backbone,
             train_dataset=train_ds,
             eval_dataset=valid_ds,
             loss_kwargs=loss_kwargs,
+            dataloader_persistent_workers=persistent_workers,
+            dataloader_prefetch_factor=prefetch_factor,
             tokenizer=self.tokenizer,
             args=TrainingArguments(
                 per_device_train_batch_size=batch_size,
@@ -629,6 +725,8 @@ class AnglE:
                 num_train_epochs=epochs,
                 learning_rate=learning_rate,
                 fp16=fp16,
+                bf16=bf16,
+                tf32=True if bf16 and is_torch_tf32_available() else None,
                 logging_steps=logging_steps,
                 save_strategy=save_strategy,
                 eval_steps=eval_steps,
@@ -637,18 +735,25 @@ class AnglE:
                 save_total_limit=save_total_limit,
                 load_best_model_at_end=False,
                 ddp_find_unused_parameters=False if self.gpu_count > 1 else None,
+                ddp_broadcast_buffers=False if is_ddp else None,
+                dataloader_drop_last=is_ddp,
                 label_names=['labels', 'seperate_ids', 'similar_matrix'],
+                dataloader_num_workers=dataloader_num_workers,
+                dataloader_pin_memory=pin_memory,
+                group_by_length=group_by_length,
+                length_column_name='input_ids_lengths',
                 **argument_kwargs,
             ),
             data_collator=AngleDataCollator(
-                self.tokenizer, return_tensors="pt", max_length=self.max_length, compute_similar_matrix=compute_similar_matrix
+                self.tokenizer, padding=padding, return_tensors="pt", max_length=self.max_length,
+                pad_to_multiple_of=8 if group_by_length and pad_insensitive else None,
+                compute_similar_matrix=compute_similar_matrix
             ),
             **trainer_kwargs
         )
-        if torch.__version__ >= "2" and sys.platform != "win32":
-            self.backbone = torch.compile(self.backbone)
-
         trainer.train()
+        # restore the eager forward, so that later encode / evaluate calls don't recompile per shape
+        self.backbone.__dict__.pop('forward', None)
         self.backbone.save_pretrained(output_dir)
 
     def evaluate(self, data: Dataset, batch_size: int = 32, threshold: Optional[float] = None, device: Any = None):
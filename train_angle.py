@@ -2,17 +2,23 @@
 
 import os
 import json
-import gzip
 import csv
 import argparse
 import random
-from collections import defaultdict
+import hashlib
+import inspect
+from itertools import islice
 
+import orjson
 import numpy as np
+import pandas as pd
 import torch
 from tqdm import tqdm
-from datasets import load_dataset, Dataset, DatasetDict
-from angle import AnglE, AngleDataTokenizer, l2_normalize
+from boltons.iterutils import chunked_iter
+from transformers.utils import is_torch_bf16_gpu_available
+from datasets import load_dataset, concatenate_datasets, Dataset, DatasetDict, Value
+from datasets.fingerprint import Hasher
+from angle import AnglE, AngleDataTokenizer
 
 
 parser = argparse.ArgumentParser()
@@ -44,6 +50,10 @@ parser.add_argument('--gradient_accumulation_steps', type=int, default=1, help='
 parser.add_argument('--do_eval', type=int, default=1, choices=[0, 1], help='Specify do_eval, default 1')
 parser.add_argument('--debug_sample_size', type=int, default=None, help='Specify debug_sample_size, default None')
 parser.add_argument('--compute_similar_matrix', type=int, default=1, choices=[0, 1], help='Specify compute_similar_matrix, default 1')
+parser.add_argument('--group_by_length', type=int, default=0, choices=[0, 1], help='Specify group_by_length, default 0')
+parser.add_argument('--torch_compile', type=int, default=0, choices=[0, 1], help='Specify torch_compile, default 0')
+parser.add_argument('--bf16', type=int, default=1, choices=[0, 1], help='Specify bf16, default 1')
+parser.add_argument('--cache_dir', type=str, default='.cache', help='Specify cache dir of tokenized datasets, default .cache')
 parser.add_argument('--model_name', type=str, default='NousResearch/Llama-2-7b-hf',
                     help='Specify model_name, default NousResearch/Llama-2-7b-hf')
 args = parser.parse_args()
@@ -55,6 +65,15 @@ if args.seed is not None:
     np.random.seed(args.seed)
     torch.manual_seed(args.seed)
 
+# cuDNN autotuning re-benchmarks every new input shape, so only enable it when batches are padded
+# to a static max length (torch_compile without length grouping). TF32 matmuls are always allowed.
+torch.backends.cudnn.benchmark = bool(args.torch_compile) and not args.group_by_length
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+if hasattr(torch.backends.cuda, 'enable_flash_sdp'):
+    torch.backends.cuda.enable_flash_sdp(True)
+    torch.backends.cuda.enable_mem_efficient_sdp(True)
+
 TASK_MAPPING = {
     'NLI-STS': 'nli-sts',
     'STS-B': ('mteb/stsbenchmark-sts', ),
@@ -62,6 +81,7 @@ TASK_MAPPING = {
     'QQP': ('SetFit/qqp', ),
     'QNLI': ('SetFit/qnli', ),
     'RTE': ('SetFit/rte', ),
+    'CSTS': 'csts',
 }
 assert args.task in TASK_MAPPING
 task_name = TASK_MAPPING[args.task]
@@ -71,40 +91,43 @@ PROMPT = 'Summarize sentence "{text}" in one word:"'
 
 
 def load_data(split_name):
-    if args.task in ['MRPC', 'QQP', 'QNLI', 'RTE']:
-        col1, col2 = 'text1', 'text2'
-    else:
-        col1, col2 = 'sentence1', 'sentence2'
+    ds = load_dataset(*task_name)[split_name]
+    if args.task not in ['MRPC', 'QQP', 'QNLI', 'RTE']:
+        ds = ds.rename_columns({'sentence1': 'text1', 'sentence2': 'text2'})
+    if args.task == 'STS-B':
+        ds = ds.select_columns(['text1', 'text2', 'score']).rename_column('score', 'label')
+        return ds.cast_column('label', Value('float32'))
+    ds = ds.select_columns(['text1', 'text2', 'label']).cast_column('label', Value('int64'))
     if args.task in ['QNLI', 'RTE']:
-        label_mapping = {
-            '1': 0, # 'not entailment'
-            '0': 1, # entailment
-        }
-    else:
-        label_mapping = {}
-    data = [
-        {'text1': obj[col1], 'text2': obj[col2],
-         'label': float(obj['score']) if args.task == 'STS-B' else int(label_mapping.get(str(obj['label']), obj['label']))}
-        for obj in load_dataset(*task_name)[split_name]
-    ]
-    return data
+        # '1': not entailment -> 0, '0': entailment -> 1
+        ds = ds.map(lambda batch: {'label': np.where(np.asarray(batch['label']) == 1, 0, 1)},
+                    batched=True,
+                    batch_size=10_000)
+    return ds
 
 
 def load_stsb_llm(split_name):
+    def is_near_duplicate(sentence1, sentence2, min_new_words=5):
+        # stop counting sentence1-only words once min_new_words is reached
+        words2 = frozenset(sentence2.split())
+        new_words = (word for word in frozenset(sentence1.split()) if word not in words2)
+        return sum(1 for _ in islice(new_words, min_new_words)) < min_new_words
+
     def load(fpaths, skip_neg=False):
         data = []
         if isinstance(fpaths, str):
             fpaths = [fpaths]
         for fpath in fpaths:
-            with open(fpath, 'r') as reader:
-                for line in reader:
-                    line = line.strip()
-                    if not line:
-                        continue
-                    obj = json.loads(line)
-                    if skip_neg and obj['score'] == 0 and len(set(obj['sentence1'].split()) - set(obj['sentence2'].split())) < 5:
-                        continue
-                    data.append({'text1': obj['sentence1'], 'text2': obj['sentence2'], 'label': float(obj['score'])})
+            with open(fpath, 'rb') as reader:
+                lines = reader.read().split(b'\n')
+            for line in lines:
+                line = line.strip()
+                if not line:
+                    continue
+                obj = orjson.loads(line)
+                if skip_neg and obj['score'] == 0 and is_near_duplicate(obj['sentence1'], obj['sentence2']):
+                    continue
+                data.append({'text1': obj['sentence1'], 'text2': obj['sentence2'], 'label': float(obj['score'])})
         return data
 
     if split_name == 'train':
@@ -131,40 +154,30 @@ def load_nli_data(exclude_neutral=True):
             'neutral': 1,
             'contradiction': 0   # '2' (contradiction)
         }
-        data = []
-        with gzip.open('./data/AllNLI.tsv.gz', 'rt', encoding='utf8') as fIn:
-            reader = csv.DictReader(fIn, delimiter='\t', quoting=csv.QUOTE_NONE)
-            for row in reader:
-                if row['split'] == 'train' and row['label'] != 'neutral':
-                    if exclude_neutral and row['label'] == 'neutral':
-                        continue
-                    sent1 = row['sentence1'].strip()
-                    sent2 = row['sentence2'].strip()
-                    data.append({'text1': sent1, 'text2': sent2, 'label': label_mapping[row['label']]})
-        return data
+        df = pd.read_csv('./data/AllNLI.tsv.gz',
+                         sep='\t',
+                         quoting=csv.QUOTE_NONE,
+                         usecols=['split', 'label', 'sentence1', 'sentence2'],
+                         dtype=str,
+                         keep_default_na=False,
+                         compression='gzip')
+        df = df[(df['split'] == 'train') & (df['label'] != 'neutral')]
+        df = pd.DataFrame({
+            'text1': df['sentence1'].str.strip(),
+            'text2': df['sentence2'].str.strip(),
+            'label': df['label'].map(label_mapping).astype('int8'),
+        })
+        return Dataset.from_pandas(df, preserve_index=False)
 
     def load_sts():
-        all_sts = []
-        for i in range(12, 17):
-            all_sts += [
-                {'text1': obj['sentence1'],
-                 'text2': obj['sentence2'],
-                 'label': float(obj['score'])}
-                for obj in load_dataset(f"./data/mteb___sts{i}-sts")['test']
-            ]
-        all_sts += [
-            {'text1': obj['sentence1'],
-             'text2': obj['sentence2'],
-             'label': float(obj['score'])}
-            for obj in load_dataset(f"./data/mteb___stsbenchmark-sts")['test']
-        ]
-        all_sts += [
-            {'text1': obj['sentence1'],
-             'text2': obj['sentence2'],
-             'label': float(obj['score'])}
-            for obj in load_dataset(f"./data/mteb___sickr-sts")['test']
-        ]
-        return all_sts
+        names = [f'sts{i}' for i in range(12, 17)] + ['stsbenchmark', 'sickr']
+        return concatenate_datasets([
+            load_dataset(f'./data/mteb___{name}-sts')['test']
+            .select_columns(['sentence1', 'sentence2', 'score'])
+            .rename_columns({'sentence1': 'text1', 'sentence2': 'text2', 'score': 'label'})
+            .cast_column('label', Value('float32'))
+            for name in names
+        ])
 
     return load_all_nli(), load_sts()
 
@@ -181,36 +194,30 @@ def load_csts_data():
     )
 
     def load_data(ds):
-        data = []
-        sentence_condition_map = defaultdict(set)
-        sentence_label_map = defaultdict(set)
-        all_conditions = set()
-        for obj in ds:
-            obj['sentence1'] = obj['sentence1'].strip()
-            obj['sentence2'] = obj['sentence2'].strip()
-            obj['condition'] = obj['condition'].strip()
-            all_conditions.add(obj['condition'])
-            sentence_condition_map[(obj['sentence1'], obj['sentence2'])].add(obj['condition'])
-            sentence_label_map[(obj['sentence1'], obj['sentence2'])].add(obj['label'])
-            # for sentence1, sentence2 in [(obj['sentence1'], obj['sentence2']), (obj['sentence2'], obj['sentence1'])]:
-            for sentence1, sentence2 in [(obj['sentence1'], obj['sentence2'])]:
-                data.append({
-                    'text1': sentence1,
-                    'text2': sentence2,
-                    'label': obj['label'],
-                    'condition': obj['condition'],
-                })
-
-        return data
+        df = ds.to_pandas()
+        for col in ['sentence1', 'sentence2', 'condition']:
+            df[col] = df[col].str.strip()
+        df = df.rename(columns={'sentence1': 'text1', 'sentence2': 'text2'})
+        return Dataset.from_pandas(df[['text1', 'text2', 'label', 'condition']], preserve_index=False)
 
     return load_data(csts_dataset['train']), load_data(csts_dataset['validation']), load_data(csts_dataset['test'])
 
 
+def to_dataset(data):
+    if isinstance(data, Dataset):
+        return data
+    return Dataset.from_list(data)
+
+
 train_data, valid_data, test_data = None, None, None
 if args.task == 'NLI-STS':
     train_data, test_data = load_nli_data()
     print('train size:', len(train_data))
     print('test size:', len(test_data))
+elif args.task == 'CSTS':
+    train_data, valid_data, test_data = load_csts_data()
+    print('train size:', len(train_data))
+    print('test size:', len(test_data))
 else:
     train_data, valid_data, test_data = [
         load_data(split) for split in ['train', 'validation', 'test']
@@ -224,20 +231,51 @@ else:
 # to Dataset
 dataset = {}
 if train_data is not None:
+   train_ds = to_dataset(train_data)
    if args.debug_sample_size is not None:
         print(f'>>> debug: sample_size={args.debug_sample_size}')
-        train_data = train_data[:args.debug_sample_size]
-   train_ds = Dataset.from_list(train_data)
+        train_ds = train_ds.select(range(min(args.debug_sample_size, len(train_ds))))
    dataset['train'] = train_ds
 if valid_data is not None:
-   valid_ds = Dataset.from_list(valid_data)
+   valid_ds = to_dataset(valid_data)
    dataset['validation'] = valid_ds
 if test_data is not None:
-   test_ds = Dataset.from_list(test_data)
+   test_ds = to_dataset(test_data)
    dataset['test'] = test_ds
 dataset = DatasetDict(dataset)
 
+
+def tokenized_cache_file(ds, split_name, tokenizer, max_length):
+    if not args.cache_dir:
+        return None
+    os.makedirs(args.cache_dir, exist_ok=True)
+    prompt_hash = hashlib.md5(PROMPT.encode('utf-8')).hexdigest()[:8]
+    # invalidate caches when the tokenization code changes
+    code_hash = hashlib.md5(inspect.getsource(AngleDataTokenizer).encode('utf-8')).hexdigest()[:8]
+    # hash the tokenizer itself (vocab, config, tokenizers version), as datasets.map fingerprints it;
+    # the name_or_path alone can point to a retrained save_dir
+    tokenizer_hash = Hasher.hash(tokenizer)[:16]
+    name = '-'.join([
+        args.task, tokenizer.name_or_path.replace('/', '_'), tokenizer_hash, str(max_length), prompt_hash, code_hash,
+        ds._fingerprint, split_name
+    ])
+    return os.path.join(args.cache_dir, f'{name}.arrow')
+
+
+def tokenize_dataset(ds, split_name, tokenizer, max_length):
+    cache_file_name = tokenized_cache_file(ds, split_name, tokenizer, max_length)
+    return ds.map(AngleDataTokenizer(tokenizer, max_length, prompt_template=PROMPT),
+                  num_proc=args.workers,
+                  batched=True,
+                  batch_size=1000,
+                  cache_file_name=cache_file_name,
+                  load_from_cache_file=True,
+                  # without a cache file there is nothing to reuse, skip the temporary arrow file
+                  keep_in_memory=cache_file_name is None)
+
+
 if args.mode == 'train':
+    use_bf16 = bool(args.bf16) and is_torch_bf16_gpu_available()
     # build model
     if 'llama' in args.model_name.lower():
         print('loading llama...')
@@ -251,7 +289,8 @@ if args.mode == 'train':
                           'lora_dropout': args.lora_dropout,
                           'target_modules': ['q_proj', 'v_proj']},
                       train_mode=True,
-                      load_kbit=args.load_kbit)
+                      load_kbit=args.load_kbit,
+                      torch_dtype=torch.bfloat16 if use_bf16 else None)
     else:
         model = AnglE(args.model_name,
                       max_length=args.maxlen,
@@ -259,9 +298,10 @@ if args.mode == 'train':
                       pooling_strategy=args.pooling_strategy,
                       train_mode=True)
     
-    train_ds = dataset['train'].shuffle().map(AngleDataTokenizer(model.tokenizer, model.max_length, prompt_template=PROMPT), num_proc=args.workers)
+    train_ds = dataset['train'].shuffle(seed=args.seed, keep_in_memory=True, writer_batch_size=50_000)
+    train_ds = tokenize_dataset(train_ds, 'train', model.tokenizer, model.max_length)
     if args.do_eval:
-        valid_ds = dataset['validation'].map(AngleDataTokenizer(model.tokenizer, model.max_length, prompt_template=PROMPT), num_proc=args.workers)
+        valid_ds = tokenize_dataset(dataset['validation'], 'validation', model.tokenizer, model.max_length)
     else:
         valid_ds = None
     
@@ -276,6 +316,13 @@ if args.mode == 'train':
         eval_steps=args.eval_steps if args.do_eval == 1 and args.eval_steps is not None else None,
         warmup_steps=args.warmup_steps,
         gradient_accumulation_steps=args.gradient_accumulation_steps,
+        bf16=use_bf16,
+        dataloader_num_workers=max(4, args.workers // 2),
+        pin_memory=True,
+        persistent_workers=True,
+        prefetch_factor=4,
+        group_by_length=bool(args.group_by_length),
+        torch_compile=bool(args.torch_compile),
         loss_kwargs={
             'w1': args.w1,
             'w2': args.w2,
@@ -288,20 +335,33 @@ if args.mode == 'train':
 elif args.mode == 'test':
     print('test...')
     model = AnglE.from_pretrained(args.save_dir, model_kwargs={'pooling_strategy': args.pooling_strategy, 'load_kbit': args.load_kbit}).cuda()
-    test_ds = dataset['test'].map(AngleDataTokenizer(model.tokenizer, model.max_length, prompt_template=PROMPT), num_proc=args.workers)
+    test_ds = tokenize_dataset(dataset['test'], 'test', model.tokenizer, model.max_length)
     corrcoef, accuracy = model.evaluate(test_ds, batch_size=args.batch_size, device=model.device)
     print(f'corrcoef: {corrcoef}, accuracy: {accuracy}')
 elif args.mode == 'test_csts':
+    assert args.task == 'CSTS', 'test_csts mode requires --task CSTS'
     print('testing csts...')
     model = AnglE.from_pretrained(args.save_dir, model_kwargs={'pooling_strategy': args.pooling_strategy, 'load_kbit': args.load_kbit}).cuda()
-    results = {}
-    for i, obj in tqdm(enumerate(csts_test_data)):
-        obj['text1'] = PROMPT.format(text=obj['text1'], condition=obj['condition'])
-        obj['text2'] = PROMPT.format(text=obj['text2'], condition=obj['condition'])
-        x_vecs = model.encode([obj['text1'], obj['text2']]).float().detach().cpu().numpy()
-        x_vecs = l2_normalize(x_vecs)
-        cos = (x_vecs[::2] * x_vecs[1::2]).sum(1)[0]
-        results[str(i)] = float(cos)
+
+    def format_prompt(batch):
+        return {
+            key: [PROMPT.format(text=text, condition=condition) for text, condition in zip(batch[key], batch['condition'])]
+            for key in ['text1', 'text2']
+        }
+
+    test_ds = dataset['test'].map(format_prompt, batched=True)
+    pairs = list(zip(test_ds['text1'], test_ds['text2']))
+    # sentences repeat across conditions, encode each unique text only once
+    texts = list(dict.fromkeys(text for pair in pairs for text in pair))
+    text_index = {text: i for i, text in enumerate(texts)}
+    # keep embeddings on the device, only the scores are copied back.
+    # upcast to float32 first, bf16 scores would be too coarse for rank correlation
+    x_vecs = torch.cat([model.encode(chunk) for chunk in tqdm(chunked_iter(texts, args.batch_size))]).float()
+    x_vecs = torch.nn.functional.normalize(x_vecs, p=2, dim=-1)
+    idx1 = torch.tensor([text_index[text1] for text1, _ in pairs], device=x_vecs.device)
+    idx2 = torch.tensor([text_index[text2] for _, text2 in pairs], device=x_vecs.device)
+    cos = (x_vecs[idx1] * x_vecs[idx2]).sum(-1).cpu().numpy()
+    results = {str(i): float(c) for i, c in enumerate(cos)}
 
     save_path = os.path.join(args.save_dir, 'test_prediction.json')
     with open(save_path, 'w') as writer: